@@ -1,17 +1,34 @@
 import io
 import os
+import functools
 import uuid
 import hashlib
+import logging
 import datetime
-import tempfile
+import threading
+import time
 import requests
-from openpyxl.utils import get_column_letter
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import xlsxwriter
+from openpyxl import load_workbook
 import pandas as pd
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape as xml_escape
 
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
+try:
+    from lxml import etree as LET
+except ImportError:  # fall back to stdlib parser if the lxml wheel is missing
+    LET = ET
+
+HAVE_LXML = LET is not ET
+
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
 from google.auth import default
+from google.auth.transport.requests import AuthorizedSession
 
 #Full column list: 
 #OUTPUT_COLUMNS = [
@@ -65,55 +82,202 @@ NUMERIC_COLUMNS = [
     "invoiceNetAmount",
 ]
 
+NUMERIC_DTYPES = {col: "float64" for col in NUMERIC_COLUMNS}
+
+COMPANY_COLUMNS = {
+    "company_code",
+    "nav_login",
+    "nav_password",
+    "nav_tax_number",
+    "nav_signature_key",
+    "nav_base_url",
+    "target_folder_id",
+    "active",
+}
+
+# Explicit dtypes for the company config sheet, so pandas skips per-value
+# inference. "active" is left to openpyxl's native TRUE/FALSE cells and
+# checked in validate_company_schema.
+COMPANY_DTYPES = {
+    col: "string" for col in COMPANY_COLUMNS if col != "active"
+}
+
+# strings_to_urls off: cell text is written as-is, no URL detection per
+# string (and no 65,530 hyperlinks-per-sheet limit)
+XLSXWRITER_OPTIONS = {
+    "constant_memory": True,
+    "strings_to_urls": False,
+}
+
+COLUMN_FORMATS = {
+    **{col: "yyyy-mm-dd" for col in DATE_COLUMNS},
+    **{col: "#,##0" for col in NUMERIC_COLUMNS},
+}
+
+logger = logging.getLogger(__name__)
+
+# VERBOSE_LOGGING (env.yaml) turns on per-page debug output
+if os.environ.get("VERBOSE_LOGGING", "false").lower() == "true":
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(logging.StreamHandler())
+
+# Companies are processed in parallel; the work is I/O-bound on NAV + Drive
+MAX_WORKERS = 8
+
+# Pages 2..N of a company's NAV query are fetched in parallel
+MAX_PAGE_WORKERS = 8
+
+# Shared HTTP session so TCP/TLS connections to NAV are pooled across
+# pages and companies (requests.Session is safe for concurrent posts).
+# The adapter only retries failed connects, where nothing reached NAV:
+# resending the same body would reuse its request id, so status retries
+# are done in fetch_invoice_page with a freshly signed request.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    # enough keep-alive connections for every company/page worker at once
+    pool_maxsize=MAX_WORKERS * MAX_PAGE_WORKERS,
+    max_retries=Retry(
+        total=3,
+        connect=3,
+        read=0,
+        status=0,
+        backoff_factor=0.5
+    )
+))
+
+# Transient NAV errors (rate limit, gateway) are retried with exponential
+# backoff; 500 and 4xx carry a NAV error body and are raised immediately.
+NAV_RETRY_STATUSES = frozenset({429, 502, 503, 504})
+NAV_MAX_RETRIES = 5
+NAV_BACKOFF_FACTOR = 0.5
+# upper bound on any single wait, whatever Retry-After asks for, so a
+# retry never outlives the Cloud Function timeout
+NAV_MAX_RETRY_DELAY = 30
+
+NAV_HEADERS = {
+    "Content-Type": "application/xml",
+    "Accept-Encoding": "gzip, deflate",
+    "Connection": "keep-alive",
+}
+
 # =========================================================
 # Utilities
 # =========================================================
 
-def utc_now_iso():
-    return datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+def utc_now():
+    return datetime.datetime.utcnow().replace(microsecond=0)
+
 
+def utc_now_iso(dt=None):
+    return (dt or utc_now()).isoformat() + "Z"
 
-def masked_timestamp(dt_iso):
-    dt = datetime.datetime.strptime(dt_iso, "%Y-%m-%dT%H:%M:%SZ")
-    return dt.strftime("%Y%m%d%H%M%S")
+
+def masked_timestamp(dt):
+    # same as dt.strftime("%Y%m%d%H%M%S"), without strftime's overhead
+    return (
+        f"{dt.year:04d}{dt.month:02d}{dt.day:02d}"
+        f"{dt.hour:02d}{dt.minute:02d}{dt.second:02d}"
+    )
+
+
+def parse_date(text):
+    try:
+        return datetime.date.fromisoformat(text)
+    except (TypeError, ValueError):
+        return None
 
 
+def parse_number(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+# NAV fields converted while the response is parsed, so the DataFrame is
+# built with final values (unparseable -> None, like errors="coerce")
+FIELD_PARSERS = {
+    **{col: parse_date for col in DATE_COLUMNS},
+    **{col: parse_number for col in NUMERIC_COLUMNS},
+}
+
+
+# bound once at import; these run for every NAV page.
+# NAV expects both digests as uppercase hex, so .upper() stays.
+_sha512 = hashlib.sha512
+_sha3_512 = hashlib.sha3_512
+
+
+@functools.lru_cache(maxsize=256)
 def password_hash(password):
-    return hashlib.sha512(password.encode()).hexdigest().upper()
+    return _sha512(password.encode()).hexdigest().upper()
+
+
+def request_signature(request_id, dt, signature_key_bytes):
+    # signature key is encoded once per company by the caller
+    return _sha3_512(b"".join((
+        request_id.encode(),
+        masked_timestamp(dt).encode(),
+        signature_key_bytes
+    ))).hexdigest().upper()
+
+def excel_rows(df):
+    # NaN / NaT -> empty cell, as DataFrame.to_excel does
+    return df.astype(object).where(df.notna(), None).itertuples(
+        index=False,
+        name=None
+    )
 
 
-def request_signature(request_id, timestamp, signature_key):
-    base = request_id + masked_timestamp(timestamp) + signature_key
-    return hashlib.sha3_512(base.encode()).hexdigest().upper()
+def write_excel_with_autowidth(df, output, sheet_name="Sheet1", max_width=60):
+    # constant_memory: xlsxwriter flushes each row to a temp file as it
+    # is written, keeping the worksheet out of memory
+    wb = xlsxwriter.Workbook(output, XLSXWRITER_OPTIONS)
+    ws = wb.add_worksheet(sheet_name)
 
-def write_excel_with_autowidth(df, path, sheet_name="Sheet1", max_width=60):
-    with pd.ExcelWriter(path, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name=sheet_name)
+    # ---- date / numeric formatting ----
+    formats = [
+        wb.add_format({"num_format": COLUMN_FORMATS[col]})
+        if col in COLUMN_FORMATS else None
+        for col in df.columns
+    ]
 
-        ws = writer.book[sheet_name]
+    # ---- auto column widths ----
+    for idx, col in enumerate(df.columns):
+        series = df[col].astype(str)
+        max_len = max(series.map(len).max(), len(col))
+        ws.set_column(idx, idx, min(max_len + 2, max_width), formats[idx])
 
-        # ---- auto column widths ----
-        for idx, col in enumerate(df.columns, start=1):
-            series = df[col].astype(str)
-            max_len = max(series.map(len).max(), len(col))
-            ws.column_dimensions[get_column_letter(idx)].width = min(
-                max_len + 2,
-                max_width
-            )
+    ws.write_row(0, 0, list(df.columns))
+
+    for row_idx, row in enumerate(excel_rows(df), start=1):
+        for col_idx, value in enumerate(row):
+            ws.write(row_idx, col_idx, value, formats[col_idx])
+
+    wb.close()
+
+
+def append_excel_rows(fh, df, output):
+    wb = load_workbook(fh)
+    ws = wb.active
 
-        # ---- date formatting ----
-        for col in DATE_COLUMNS:
-            col_idx = df.columns.get_loc(col) + 1
-            col_letter = get_column_letter(col_idx)
-            for cell in ws[col_letter][1:]:
-                cell.number_format = "yyyy-mm-dd"
+    # align new rows to the existing header, adding any new columns
+    header = [cell.value for cell in ws[1]]
+    for col in df.columns:
+        if col not in header:
+            header.append(col)
+            ws.cell(row=1, column=len(header), value=col)
 
-        # ---- numeric formatting ----
-        for col in NUMERIC_COLUMNS:
-            col_idx = df.columns.get_loc(col) + 1
-            col_letter = get_column_letter(col_idx)
-            for cell in ws[col_letter][1:]:
-                cell.number_format = "#,##0"
+    formats = [COLUMN_FORMATS.get(col) for col in header]
+
+    for row in excel_rows(df.reindex(columns=header)):
+        ws.append(row)
+        for cell, fmt in zip(ws[ws.max_row], formats):
+            if fmt:
+                cell.number_format = fmt
+
+    wb.save(output)
 
 
 # =========================================================
@@ -134,18 +298,7 @@ def validate_environment(minimal=False):
 
 
 def validate_company_schema(df):
-    required_columns = {
-        "company_code",
-        "nav_login",
-        "nav_password",
-        "nav_tax_number",
-        "nav_signature_key",
-        "nav_base_url",
-        "target_folder_id",
-        "active",
-    }
-
-    missing = required_columns - set(df.columns)
+    missing = COMPANY_COLUMNS - set(df.columns)
     if missing:
         raise ValueError(
             f"Company config Excel missing columns: {', '.join(sorted(missing))}"
@@ -157,7 +310,9 @@ def validate_company_schema(df):
     if not df["company_code"].is_unique:
         raise ValueError("company_code must be unique")
 
-    if not df["active"].isin([True, False]).all():
+    # a bool column is valid by construction; only scan mixed/object ones
+    active = df["active"]
+    if active.dtype != bool and not active.isin([True, False]).all():
         raise ValueError("active column must contain TRUE/FALSE only")
 
 
@@ -165,21 +320,70 @@ def validate_company_schema(df):
 # Google Drive Wrapper (Shared Drive safe)
 # =========================================================
 
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files"
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+DRIVE_BATCH_SIZE = 100  # Drive API limit per batch request
+
+# Files up to this size go up in a single multipart request; larger ones
+# use a resumable upload in UPLOAD_CHUNK_SIZE pieces
+SIMPLE_UPLOAD_MAX_SIZE = 5 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+CSV_MIMETYPE = "text/csv"
+
+
+def upload_media(fh, mimetype):
+    fh.seek(0)
+    return MediaIoBaseUpload(
+        fh,
+        mimetype=mimetype,
+        resumable=fh.getbuffer().nbytes > SIMPLE_UPLOAD_MAX_SIZE,
+        chunksize=UPLOAD_CHUNK_SIZE
+    )
+
+
+def drive_query_escape(value):
+    return str(value).replace("\\", "\\\\").replace("'", "\\'")
+
+
+@functools.lru_cache(maxsize=None)
+def drive_credentials():
+    creds, _ = default()
+    return creds
+
+
+@functools.lru_cache(maxsize=None)
+def drive_discovery_document():
+    # bundled Drive v3 discovery doc, read once. Kept as the JSON string:
+    # build_from_document parses it into a fresh dict per client, since it
+    # and the first .files() call mutate the document in place
+    return get_static_doc("drive", "v3")
+
+
 class DriveClient:
     def __init__(self):
-        creds, _ = default()
-        self.service = build("drive", "v3", credentials=creds)
+        creds = drive_credentials()
+        self.service = build_from_document(
+            drive_discovery_document(),
+            credentials=creds
+        )
+        # plain authorized HTTP for binary media downloads
+        self.session = AuthorizedSession(creds)
 
     def get_metadata(self, file_id):
         return self.service.files().get(
             fileId=file_id,
-            fields="id, name, mimeType",
+            fields="id, name, mimeType, version",
             supportsAllDrives=True
         ).execute()
 
-    def download_as_excel_stream(self, file_id):
-        meta = self.get_metadata(file_id)
-        mime = meta["mimeType"]
+    def download_as_excel_stream(self, file_id, mime=None):
+        if mime is None:
+            mime = self.get_metadata(file_id)["mimeType"]
+
+        fh = io.BytesIO()
 
         if mime == "application/vnd.google-apps.spreadsheet":
             request = self.service.files().export(
@@ -189,219 +393,419 @@ class DriveClient:
                     "spreadsheetml.sheet"
                 )
             )
-        else:
-            request = self.service.files().get_media(
-                fileId=file_id,
-                supportsAllDrives=True
-            )
 
-        fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, request)
+            downloader = MediaIoBaseDownload(
+                fh,
+                request,
+                chunksize=DOWNLOAD_CHUNK_SIZE
+            )
 
-        done = False
-        while not done:
-            _, done = downloader.next_chunk()
+            done = False
+            while not done:
+                _, done = downloader.next_chunk()
+        else:
+            # single streamed GET instead of chunked MediaIoBaseDownload
+            with self.session.get(
+                f"{DRIVE_FILES_URL}/{file_id}",
+                params={"alt": "media", "supportsAllDrives": "true"},
+                stream=True,
+                timeout=60
+            ) as resp:
+                resp.raise_for_status()
+                for chunk in resp.iter_content(chunk_size=1 << 20):
+                    fh.write(chunk)
 
         fh.seek(0)
         return fh
 
-    def find_file_in_folder(self, filename, folder_id):
+    def _list_file_in_folder(self, filename, folder_id):
         query = (
-            f"name='{filename}' and "
-            f"'{folder_id}' in parents and "
+            f"name='{drive_query_escape(filename)}' and "
+            f"'{drive_query_escape(folder_id)}' in parents and "
             f"trashed=false"
         )
 
-        results = self.service.files().list(
+        return self.service.files().list(
             q=query,
-            fields="files(id, name)",
+            fields="nextPageToken, incompleteSearch, files(id, appProperties)",
+            spaces="drive",
             supportsAllDrives=True,
             includeItemsFromAllDrives=True
-        ).execute()
+        )
 
+    @staticmethod
+    def _first_listed_file(results):
+        # A partial listing must not be read as "not found": that would
+        # create a second company file next to the existing one.
         files = results.get("files", [])
-        return files[0]["id"] if files else None
+        if files:
+            return files[0]
+        if results.get("incompleteSearch") or results.get("nextPageToken"):
+            raise RuntimeError("Drive file lookup returned incomplete results")
+        return None
 
-    def upload_excel(self, local_path, filename, folder_id):
-        media = MediaFileUpload(
-            local_path,
-            mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+    def find_file_in_folder(self, filename, folder_id):
+        results = self._list_file_in_folder(filename, folder_id).execute()
+        return self._first_listed_file(results)
+
+    def find_files_in_folders(self, lookups):
+        # Batched find_file_in_folder: {key: (filename, folder_id)} ->
+        # {key: file or None}, one round-trip per DRIVE_BATCH_SIZE
+        # lookups. Keys whose lookup failed or was incomplete are left out.
+        found = {}
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                try:
+                    found[request_id] = self._first_listed_file(response)
+                except RuntimeError as e:
+                    logger.warning("%s: %s", request_id, e)
+
+        keys = list(lookups)
+        for start in range(0, len(keys), DRIVE_BATCH_SIZE):
+            batch = self.service.new_batch_http_request(callback=callback)
+            for key in keys[start:start + DRIVE_BATCH_SIZE]:
+                batch.add(
+                    self._list_file_in_folder(*lookups[key]),
+                    request_id=key
+                )
+            batch.execute()
+
+        return found
+
+    def upload_file(
+        self,
+        fh,
+        filename,
+        folder_id,
+        mimetype,
+        app_properties=None
+    ):
+        media = upload_media(fh, mimetype)
+
+        body = {"name": filename, "parents": [folder_id]}
+        if app_properties:
+            body["appProperties"] = app_properties
 
         return self.service.files().create(
-            body={"name": filename, "parents": [folder_id]},
+            body=body,
             media_body=media,
             fields="id",
             supportsAllDrives=True
         ).execute()
 
-    def update_excel(self, file_id, local_path):
-        media = MediaFileUpload(
-            local_path,
-            mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    def upload_excel(self, fh, filename, folder_id, app_properties=None):
+        return self.upload_file(
+            fh,
+            filename,
+            folder_id,
+            XLSX_MIMETYPE,
+            app_properties
         )
 
+    def update_excel(self, file_id, fh, app_properties=None):
+        media = upload_media(fh, XLSX_MIMETYPE)
+
         return self.service.files().update(
             fileId=file_id,
+            body={"appProperties": app_properties} if app_properties else None,
             media_body=media,
             supportsAllDrives=True
         ).execute()
 
 
+# googleapiclient's http object is not thread-safe -> one client per thread,
+# reused for every Drive call made on that thread
+_thread_local = threading.local()
+
+
+def get_drive_client():
+    drive = getattr(_thread_local, "drive", None)
+    if drive is None:
+        drive = DriveClient()
+        _thread_local.drive = drive
+    return drive
+
+
 # =========================================================
 # NAV XML & API
 # =========================================================
 
+NS_API = "http://schemas.nav.gov.hu/OSA/3.0/api"
+NS_COMMON = "http://schemas.nav.gov.hu/NTCA/1.0/common"
+
+# Clark-notation ("{ns}tag") names for the response elements we read,
+# built once instead of per call
+NS_API_BRACED = "{" + NS_API + "}"
+INVOICE_DIGEST_TAG = NS_API_BRACED + "invoiceDigest"
+CURRENT_PAGE_TAG = NS_API_BRACED + "currentPage"
+AVAILABLE_PAGE_TAG = NS_API_BRACED + "availablePage"
+
+# Fixed-shape QueryInvoiceDigestRequest envelope. The document never
+# changes structure, so it is filled in as a template instead of being
+# rebuilt with ElementTree on every page.
+SOFTWARE_XML = (
+    "<software>"
+    "<softwareId>CORPOFINCOMPEX0001</softwareId>"
+    "<softwareName>WeeklyInvoiceExport</softwareName>"
+    "<softwareOperation>ONLINE_SERVICE</softwareOperation>"
+    "<softwareMainVersion>1.0</softwareMainVersion>"
+    "<softwareDevName>Corpofin Kft.</softwareDevName>"
+    "<softwareDevContact>balazs.dedinszky@corpofin.hu</softwareDevContact>"
+    "<softwareDevCountryCode>HU</softwareDevCountryCode>"
+    "</software>"
+)
+
+QUERY_XML_TEMPLATE = (
+    '<QueryInvoiceDigestRequest'
+    ' xmlns="' + NS_API + '"'
+    ' xmlns:common="' + NS_COMMON + '">'
+    # --- header (common) ---
+    "<common:header>"
+    "<common:requestId>{request_id}</common:requestId>"
+    "<common:timestamp>{timestamp}</common:timestamp>"
+    "<common:requestVersion>3.0</common:requestVersion>"
+    "<common:headerVersion>1.0</common:headerVersion>"
+    "</common:header>"
+    # --- user (common) ---
+    "<common:user>"
+    "<common:login>{login}</common:login>"
+    '<common:passwordHash cryptoType="SHA-512">{password_hash}</common:passwordHash>'
+    "<common:taxNumber>{tax_number}</common:taxNumber>"
+    '<common:requestSignature cryptoType="SHA3-512">{signature}</common:requestSignature>'
+    "</common:user>"
+    # --- software (api, children ALSO api!) ---
+    + SOFTWARE_XML +
+    # --- paging & direction ---
+    "<page>{page}</page>"
+    "<invoiceDirection>INBOUND</invoiceDirection>"
+    # --- query params ---
+    "<invoiceQueryParams><mandatoryQueryParams><invoiceIssueDate>"
+    "<dateFrom>{date_from}</dateFrom>"
+    "<dateTo>{date_to}</dateTo>"
+    "</invoiceIssueDate></mandatoryQueryParams></invoiceQueryParams>"
+    "</QueryInvoiceDigestRequest>"
+)
+
+
 def build_query_xml(
     request_id,
     timestamp,
-    company,
+    login,
+    password_hash_value,
+    tax_number,
+    signature,
     page,
     date_from,
     date_to
 ):
-    NS_API = "http://schemas.nav.gov.hu/OSA/3.0/api"
-    NS_COMMON = "http://schemas.nav.gov.hu/NTCA/1.0/common"
-
-    ET.register_namespace("", NS_API)
-    ET.register_namespace("common", NS_COMMON)
-
-    root = ET.Element(f"{{{NS_API}}}QueryInvoiceDigestRequest")
+    return QUERY_XML_TEMPLATE.format(
+        request_id=xml_escape(request_id),
+        timestamp=xml_escape(timestamp),
+        login=xml_escape(login),
+        password_hash=password_hash_value,
+        tax_number=xml_escape(tax_number),
+        signature=signature,
+        page=page,
+        date_from=xml_escape(date_from),
+        date_to=xml_escape(date_to),
+    ).encode("utf-8")
+
+
+
+
+def pad_columns(cols, n_rows):
+    # fields missing from some invoices -> None, keeping columns aligned
+    for values in cols.values():
+        if len(values) < n_rows:
+            values.extend([None] * (n_rows - len(values)))
+
+
+def parse_response(stream):
+    # invoiceDigest fields are all in the api namespace, so the
+    # "{NS_API}" prefix can be sliced off instead of split on "}"
+    prefix_len = len(NS_API_BRACED)
+
+    current_page = 1
+    available_page = 1
+
+    # Column-wise (field -> values) instead of one dict per invoice, so the
+    # DataFrame is built without transposing rows. Only OUTPUT_COLUMNS are
+    # kept; other digest fields are skipped while parsing.
+    cols = {col: [] for col in OUTPUT_COLUMNS}
+    n_rows = 0
+
+    # Stream the document and drop each invoiceDigest once it is read,
+    # so memory stays flat regardless of page size
+    if HAVE_LXML:
+        # lxml filters tags in C: no Python-level event per invoice field
+        events = LET.iterparse(
+            stream,
+            events=("end",),
+            tag=(INVOICE_DIGEST_TAG, CURRENT_PAGE_TAG, AVAILABLE_PAGE_TAG)
+        )
+    else:
+        events = LET.iterparse(stream, events=("end",))
 
-    # --- header (common) ---
-    header = ET.SubElement(root, f"{{{NS_COMMON}}}header")
-    ET.SubElement(header, f"{{{NS_COMMON}}}requestId").text = request_id
-    ET.SubElement(header, f"{{{NS_COMMON}}}timestamp").text = timestamp
-    ET.SubElement(header, f"{{{NS_COMMON}}}requestVersion").text = "3.0"
-    ET.SubElement(header, f"{{{NS_COMMON}}}headerVersion").text = "1.0"
+    for _, elem in events:
+        tag = elem.tag
 
-    # --- user (common) ---
-    user = ET.SubElement(root, f"{{{NS_COMMON}}}user")
-    ET.SubElement(user, f"{{{NS_COMMON}}}login").text = company["nav_login"]
-
-    ET.SubElement(
-        user,
-        f"{{{NS_COMMON}}}passwordHash",
-        cryptoType="SHA-512"
-    ).text = password_hash(company["nav_password"])
-
-    ET.SubElement(
-        user,
-        f"{{{NS_COMMON}}}taxNumber"
-    ).text = str(company["nav_tax_number"])
-
-    ET.SubElement(
-        user,
-        f"{{{NS_COMMON}}}requestSignature",
-        cryptoType="SHA3-512"
-    ).text = request_signature(
-        request_id,
-        timestamp,
-        company["nav_signature_key"]
-    )
+        if tag == INVOICE_DIGEST_TAG:
+            for child in elem:
+                name = child.tag[prefix_len:]
+                values = cols.get(name)
+                if values is None:
+                    continue
 
-    # --- software (api, children ALSO api!) ---
-    software = ET.SubElement(root, f"{{{NS_API}}}software")
-    ET.SubElement(software, f"{{{NS_API}}}softwareId").text = "CORPOFINCOMPEX0001"
-    ET.SubElement(software, f"{{{NS_API}}}softwareName").text = "WeeklyInvoiceExport"
-    ET.SubElement(software, f"{{{NS_API}}}softwareOperation").text = "ONLINE_SERVICE"
-    ET.SubElement(software, f"{{{NS_API}}}softwareMainVersion").text = "1.0"
-    ET.SubElement(software, f"{{{NS_API}}}softwareDevName").text = "Corpofin Kft."
-    ET.SubElement(software, f"{{{NS_API}}}softwareDevContact").text = "balazs.dedinszky@corpofin.hu"
-    ET.SubElement(software, f"{{{NS_API}}}softwareDevCountryCode").text = "HU"
+                parser = FIELD_PARSERS.get(name)
+                values.append(
+                    child.text if parser is None else parser(child.text)
+                )
+            n_rows += 1
+            pad_columns(cols, n_rows)
 
-    # --- paging & direction ---
-    ET.SubElement(root, f"{{{NS_API}}}page").text = str(page)
-    ET.SubElement(root, f"{{{NS_API}}}invoiceDirection").text = "INBOUND"
+            elem.clear()
+            if HAVE_LXML:
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
 
-    # --- query params ---
-    iq = ET.SubElement(root, f"{{{NS_API}}}invoiceQueryParams")
-    mandatory = ET.SubElement(iq, f"{{{NS_API}}}mandatoryQueryParams")
-    iid = ET.SubElement(mandatory, f"{{{NS_API}}}invoiceIssueDate")
-    ET.SubElement(iid, f"{{{NS_API}}}dateFrom").text = date_from
-    ET.SubElement(iid, f"{{{NS_API}}}dateTo").text = date_to
+        elif tag == CURRENT_PAGE_TAG:
+            current_page = int(elem.text)
 
-    return ET.tostring(root, encoding="utf-8")
+        elif tag == AVAILABLE_PAGE_TAG:
+            available_page = int(elem.text)
+    
+    logger.debug("Invoices parsed: %d", n_rows)
+    return cols, n_rows, current_page, available_page
 
 
+def merge_columns(cols, n_rows, page_cols, page_rows):
+    for name, values in page_cols.items():
+        target = cols.get(name)
+        if target is None:
+            target = cols[name] = [None] * n_rows
+        target.extend(values)
 
+    n_rows += page_rows
+    pad_columns(cols, n_rows)
+    return n_rows
 
-def parse_response(xml_text):
-    NS_API = "http://schemas.nav.gov.hu/OSA/3.0/api"
 
-    root = ET.fromstring(xml_text)
 
-    def findtext(parent, tag, default=None):
-        el = parent.find(f"{{{NS_API}}}{tag}")
-        return el.text if el is not None else default
+def build_page_query(nav_user, page, date_from, date_to):
+    # Fresh request id / timestamp / signature on every call (NAV requires
+    # unique request ids), so pages and retries are sent independently
+    request_id = uuid.uuid4().hex[:30]
+    now = utc_now()
 
-    current_page = int(
-        root.findtext(f".//{{{NS_API}}}currentPage", "1")
-    )
-    available_page = int(
-        root.findtext(f".//{{{NS_API}}}availablePage", "1")
+    return build_query_xml(
+        request_id=request_id,
+        timestamp=utc_now_iso(now),
+        login=nav_user["login"],
+        password_hash_value=nav_user["password_hash"],
+        tax_number=nav_user["tax_number"],
+        signature=request_signature(
+            request_id,
+            now,
+            nav_user["signature_key"]
+        ),
+        page=page,
+        date_from=date_from,
+        date_to=date_to
     )
 
-    rows = []
 
-    for inv in root.findall(f".//{{{NS_API}}}invoiceDigest"):
-        row = {}
-        for child in inv:
-            # Strip namespace from tag name
-            tag = child.tag.split("}", 1)[-1]
-            row[tag] = child.text
-        rows.append(row)
-    
-    print("Invoices parsed:", len(rows))
-    return rows, current_page, available_page
+def retry_delay(resp, attempt):
+    delay = NAV_BACKOFF_FACTOR * 2 ** attempt
+    retry_after = resp.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        delay = max(delay, int(retry_after))
+    return min(delay, NAV_MAX_RETRY_DELAY)
 
 
+def fetch_invoice_page(company, nav_user, page, date_from, date_to):
+    for attempt in range(NAV_MAX_RETRIES + 1):
+        xml = build_page_query(nav_user, page, date_from, date_to)
 
-def fetch_all_invoices(company, date_from, date_to):
-    all_rows = []
-    page = 1
-    last_request_xml = None
-    last_response_text = None
+        with SESSION.post(
+            f"{company['nav_base_url']}/queryInvoiceDigest",
+            data=xml,
+            headers=NAV_HEADERS,
+            timeout=30,
+            stream=True
+        ) as resp:
+            if resp.status_code == 200:
+                # parse straight off the (gunzipped) socket, no resp.text
+                resp.raw.decode_content = True
+                page_cols, page_rows, _, available_page = parse_response(
+                    resp.raw
+                )
+                return page_cols, page_rows, available_page
+
+            if (
+                resp.status_code not in NAV_RETRY_STATUSES
+                or attempt == NAV_MAX_RETRIES
+            ):
+                raise RuntimeError(
+                    f"NAV HTTP {resp.status_code}",
+                    xml.decode("utf-8"),
+                    resp.text
+                )
 
-    while True:
-        request_id = uuid.uuid4().hex[:30]
-        timestamp = utc_now_iso()
+            delay = retry_delay(resp, attempt)
 
-        xml = build_query_xml(
-            request_id,
-            timestamp,
-            company,
+        logger.debug(
+            "NAV HTTP %d on page %d, retrying in %.1fs",
+            resp.status_code,
             page,
-            date_from,
-            date_to
+            delay
         )
+        time.sleep(delay)
 
-        last_request_xml = xml.decode("utf-8")
 
-        resp = requests.post(
-            f"{company['nav_base_url']}/queryInvoiceDigest",
-            data=xml,
-            headers={"Content-Type": "application/xml"},
-            timeout=30
-        )
+def fetch_all_invoices(company, date_from, date_to):
+    # Invariant per company -> computed once, not on every page
+    nav_user = {
+        "login": str(company["nav_login"]),
+        "password_hash": password_hash(company["nav_password"]),
+        "tax_number": str(company["nav_tax_number"]),
+        "signature_key": str(company["nav_signature_key"]).encode(),
+    }
 
-        last_response_text = resp.text
+    # Page 1 tells us how many pages there are
+    cols, n_rows, available_page = fetch_invoice_page(
+        company,
+        nav_user,
+        1,
+        date_from,
+        date_to
+    )
 
-        if resp.status_code != 200:
-            raise RuntimeError(
-                f"NAV HTTP {resp.status_code}",
-                last_request_xml,
-                last_response_text
+    # ... then pages 2..N are fetched concurrently and merged in order
+    if available_page > 1:
+        with ThreadPoolExecutor(
+            max_workers=min(MAX_PAGE_WORKERS, available_page - 1)
+        ) as executor:
+            pages = executor.map(
+                lambda page: fetch_invoice_page(
+                    company,
+                    nav_user,
+                    page,
+                    date_from,
+                    date_to
+                ),
+                range(2, available_page + 1)
             )
 
-        rows, current_page, available_page = parse_response(resp.text)
-        all_rows.extend(rows)
-
-        if current_page >= available_page:
-            break
-        page += 1
+            for page_cols, page_rows, _ in pages:
+                n_rows = merge_columns(cols, n_rows, page_cols, page_rows)
 
-    return pd.DataFrame(all_rows), last_request_xml, last_response_text
+    # NAV request/response XML only matters on failure and travels in the
+    # RuntimeError args raised by fetch_invoice_page.
+    # Fixed output schema: fields NAV omitted entirely become empty columns.
+    return pd.DataFrame(cols, columns=OUTPUT_COLUMNS, copy=False).astype(
+        NUMERIC_DTYPES
+    )
 
 
 
@@ -410,47 +814,200 @@ def fetch_all_invoices(company, date_from, date_to):
 # =========================================================
 
 def load_companies_from_drive():
-    drive = DriveClient()
+    drive = get_drive_client()
     file_id = os.environ["COMPANY_CONFIG_FILE_ID"]
 
-    fh = drive.download_as_excel_stream(file_id)
-    df = pd.read_excel(fh, sheet_name="companies")
+    # Drive bumps "version" on every edit, so a warm instance only
+    # re-downloads the config when it actually changed
+    meta = drive.get_metadata(file_id)
+    return read_company_config(file_id, meta.get("version"), meta["mimeType"])
+
+
+@functools.lru_cache(maxsize=1)
+def read_company_config(file_id, version, mime):
+    drive = get_drive_client()
+
+    fh = drive.download_as_excel_stream(file_id, mime)
+    df = pd.read_excel(
+        fh,
+        sheet_name="companies",
+        engine="openpyxl",
+        usecols=lambda col: col in COMPANY_COLUMNS,
+        dtype=COMPANY_DTYPES
+    )
 
     validate_company_schema(df)
-    return df[df["active"] == True]
 
+    # astype(bool): validation also lets 1/0 through, which .loc would
+    # take as row labels instead of a mask. Plain dicts: cheap field
+    # lookups, no Series boxing per row
+    return df.loc[df["active"].astype(bool)].to_dict(orient="records")
 
-def upsert_company_excel(df_new, company_code, folder_id):
-    drive = DriveClient()
-    filename = f"{company_code}_invoices.xlsx"
 
-    existing_id = drive.find_file_in_folder(filename, folder_id)
+def company_filename(company_code):
+    return f"{company_code}_invoices.xlsx"
 
-    if existing_id:
-        fh = drive.download_as_excel_stream(existing_id)
-        df_existing = pd.read_excel(fh)
-        df_final = pd.concat([df_existing, df_new], ignore_index=True)
-    else:
-        df_final = df_new
 
-    with tempfile.TemporaryDirectory() as tmp:
-        path = os.path.join(tmp, filename)
-        write_excel_with_autowidth(df_final, path)
+def find_company_files(companies):
+    drive = get_drive_client()
+
+    # a failed batch must not abort every company: return None and let
+    # find_existing_company_file look each file up on its own
+    try:
+        return drive.find_files_in_folders({
+            str(company["company_code"]): (
+                company_filename(company["company_code"]),
+                company["target_folder_id"]
+            )
+            for company in companies
+        })
+    except Exception as e:
+        logger.warning("Batched Drive lookup failed: %r", e)
+        return None
+
+
+def find_existing_company_file(company_code, folder_id, existing_files=None):
+    # existing files are normally looked up for all companies in one
+    # batch (find_company_files); fall back to a single lookup otherwise
+    if existing_files is not None and str(company_code) in existing_files:
+        return existing_files[str(company_code)]
+
+    return get_drive_client().find_file_in_folder(
+        company_filename(company_code),
+        folder_id
+    )
+
+
+def already_exported(existing, period_to):
+    # the last exported period is kept in the file's appProperties, so a
+    # re-run for the same week is detected before any NAV call and
+    # without downloading the file
+    if not existing:
+        return False
+
+    last_period_to = (existing.get("appProperties") or {}).get(
+        "last_period_to"
+    )
+    return bool(last_period_to) and last_period_to >= period_to
 
-        if existing_id:
-            drive.update_excel(existing_id, path)
-        else:
-            drive.upload_excel(path, filename, folder_id)
+
+def upsert_company_excel(df_new, company_code, folder_id, period_to, existing):
+    # nothing new this week (e.g. holidays) -> no download / re-upload
+    if df_new.empty:
+        return
+
+    drive = get_drive_client()
+    filename = company_filename(company_code)
+    app_properties = {"last_period_to": period_to}
+
+    # the finished workbook is uploaded from memory; xlsxwriter still
+    # stages the parts of a new workbook in temp files while writing
+    out = io.BytesIO()
+
+    if existing:
+        # append only the new rows instead of re-reading and rewriting
+        # the whole history through pandas
+        fh = drive.download_as_excel_stream(existing["id"])
+        append_excel_rows(fh, df_new, out)
+        drive.update_excel(existing["id"], out, app_properties)
+    else:
+        write_excel_with_autowidth(df_new, out)
+        drive.upload_excel(out, filename, folder_id, app_properties)
 
 
 def upload_summary_log(df, filename):
-    drive = DriveClient()
+    drive = get_drive_client()
     folder_id = os.environ["SUMMARY_LOG_FOLDER_ID"]
 
-    with tempfile.TemporaryDirectory() as tmp:
-        path = os.path.join(tmp, filename)
-        df.to_excel(path, index=False)
-        drive.upload_excel(path, filename, folder_id)
+    # plain CSV: the log is a handful of rows, Excel serialization is
+    # pure overhead. utf-8-sig so Excel shows accented names correctly.
+    out = io.BytesIO()
+    df.to_csv(out, index=False, encoding="utf-8-sig")
+    drive.upload_file(out, filename, folder_id, CSV_MIMETYPE)
+
+
+LOG_COLUMNS = (
+    "company_code",
+    "period_from",
+    "period_to",
+    "status",
+    "invoice_count",
+    "error",
+    "request_xml",
+    "nav_error_response",
+    "processed_at",
+)
+
+
+def process_company(company, period_from, period_to, existing_files=None):
+    # returns one summary-log row as a tuple in LOG_COLUMNS order
+    try:
+        existing = find_existing_company_file(
+            company["company_code"],
+            company["target_folder_id"],
+            existing_files
+        )
+
+        if already_exported(existing, period_to):
+            return (
+                company["company_code"],
+                period_from,
+                period_to,
+                "SKIPPED",
+                0,
+                "period already exported",
+                "",
+                "",
+                utc_now_iso()
+            )
+
+        df = fetch_all_invoices(
+            company,
+            period_from,
+            period_to
+        )
+
+        upsert_company_excel(
+            df,
+            company["company_code"],
+            company["target_folder_id"],
+            period_to,
+            existing
+        )
+
+        return (
+            company["company_code"],
+            period_from,
+            period_to,
+            "SUCCESS",
+            len(df),
+            "",
+            "",
+            "",
+            utc_now_iso()
+        )
+
+    except Exception as e:
+        request_xml = ""
+        response_xml = ""
+
+        # the summary CSV is usually opened in Excel, which caps a cell
+        # at 32,767 characters
+        if len(e.args) >= 3:
+            request_xml = e.args[1][:30000]
+            response_xml = e.args[2][:30000]
+
+        return (
+            company["company_code"],
+            period_from,
+            period_to,
+            "FAILED",
+            0,
+            str(e.args[0]),
+            request_xml,
+            response_xml,
+            utc_now_iso()
+        )
 
 
 # =========================================================
@@ -468,70 +1025,30 @@ def weekly_invoice_export(request):
     try:
         validate_environment()
         companies = load_companies_from_drive()
+        existing_files = find_company_files(companies)
 
-        log_rows = []
+        log_cols = {col: [] for col in LOG_COLUMNS}
 
-        for _, company in companies.iterrows():
-            try:
-                df, request_xml, response_xml = fetch_all_invoices(
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for row in executor.map(
+                lambda company: process_company(
                     company,
                     period_from,
-                    period_to
-                )
-
-                df["period_from"] = period_from
-                df["period_to"] = period_to
-                
-                df = df.reindex(columns=OUTPUT_COLUMNS)
-                df[DATE_COLUMNS] = df[DATE_COLUMNS].apply(pd.to_datetime, errors="coerce")
-                df[NUMERIC_COLUMNS] = df[NUMERIC_COLUMNS].apply(pd.to_numeric, errors="coerce")
-
-                upsert_company_excel(
-                    df,
-                    company["company_code"],
-                    company["target_folder_id"]
-                )
-
-                log_rows.append({
-                    "company_code": company["company_code"],
-                    "period_from": period_from,
-                    "period_to": period_to,
-                    "status": "SUCCESS",
-                    "invoice_count": len(df),
-                    "error": "",
-                    "request_xml": "",
-                    "nav_error_response": "",
-                    "processed_at": utc_now_iso()
-                })
-
-            except Exception as e:
-                request_xml = ""
-                response_xml = ""
-
-                if len(e.args) >= 3:
-                    request_xml = e.args[1][:30000]     # Excel-safe
-                    response_xml = e.args[2][:30000]
-
-                log_rows.append({
-                    "company_code": company["company_code"],
-                    "period_from": period_from,
-                    "period_to": period_to,
-                    "status": "FAILED",
-                    "invoice_count": 0,
-                    "error": str(e.args[0]),
-                    "request_xml": request_xml,
-                    "nav_error_response": response_xml,
-                    "processed_at": utc_now_iso()
-                })
-
-
-        log_df = pd.DataFrame(log_rows)
+                    period_to,
+                    existing_files
+                ),
+                companies
+            ):
+                for col, value in zip(LOG_COLUMNS, row):
+                    log_cols[col].append(value)
+
+        log_df = pd.DataFrame(log_cols, columns=LOG_COLUMNS, copy=False)
         upload_summary_log(
             log_df,
-            f"summary_{period_from}_{period_to}.xlsx"
+            f"summary_{period_from}_{period_to}.csv"
         )
 
-        return {"status": "ok", "companies": len(log_rows)}, 200
+        return {"status": "ok", "companies": len(log_df)}, 200
 
     except Exception as e:
         print("CRITICAL FAILURE:", str(e))